@@ -4,134 +4,312 @@ Preprocess city population data from Chandler and Modelski datasets.
 Outputs a normalized JSON file for the map application.
 """
 
-import csv
-import json
-import re
-from collections import defaultdict
-
+import argparse
+import codecs
+import contextlib
+import functools
+import gc
+import heapq
+import io
+import mmap
+import os
+import sys
+import tempfile
+
+import numpy as np
+import orjson
+import pandas as pd
+
+# Year keys are ints, which orjson only serialises with OPT_NON_STR_KEYS
+ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS
+
+# Importing numba and loading the cached kernel costs about 0.35 s, which its
+# ~3 ns/cell lead over NumPy only wins back on blocks of roughly 100M cells
+NUMBA_MIN_CELLS = 100_000_000
+
+@contextlib.contextmanager
+def gc_paused():
+    """Suspend cyclic garbage collection while building many small containers."""
+    was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if was_enabled:
+            gc.enable()
+
+@functools.lru_cache(maxsize=None)
 def parse_year_column(col):
     """Convert column name like 'BC_3700' or 'AD_100' to integer year."""
-    match = re.match(r'(BC|AD)_(\d+)', col)
-    if not match:
+    era, year = col[:3], col[3:]
+    if not year.isdigit():
         return None
-    era, year = match.groups()
-    year = int(year)
-    return -year if era == 'BC' else year
+    if era == 'BC_':
+        return -int(year)
+    if era == 'AD_':
+        return int(year)
+    return None
+
+# Parsed year columns, keyed by the full header row
+_HEADER_CACHE = {}
 
-def process_wide_csv(filepath, encoding='cp1252'):
-    """Process wide-format CSV where each year is a column.
+def year_columns(headers):
+    """Return a header row's year columns sorted by year, with their int32 year labels.
+
+    Results are cached per header row; callers must not modify them.
+    """
+    key = tuple(headers)
+    cached = _HEADER_CACHE.get(key)
+    if cached is None:
+        year_map = {col: parse_year_column(col) for col in key if parse_year_column(col) is not None}
+        year_cols = sorted(year_map, key=year_map.get)
+        year_labels = np.array([year_map[col] for col in year_cols], dtype=np.int32)
+        cached = _HEADER_CACHE[key] = (year_cols, year_labels)
+    return cached
+
+def read_utf8(filepath, encoding='utf-8'):
+    """Read a whole file through mmap and return its contents as UTF-8 bytes.
+
+    Input in any other encoding is transcoded in one pass over the buffer
+    rather than line by line.
+    """
+    with open(filepath, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return b''
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            data = mm[:]
+
+    if codecs.lookup(encoding).name != 'utf-8':
+        data = data.decode(encoding).encode('utf-8')
+    return data
+
+def to_utf8(filepath, encoding):
+    """Write a UTF-8 copy of a CSV next to it and return the copy's path.
+
+    The copy is only rewritten when the source is newer, so repeated runs
+    skip the legacy codec entirely. It is written to a temporary file and
+    renamed into place, so an interrupted run never leaves a truncated copy.
+    """
+    root, ext = os.path.splitext(filepath)
+    utf8_path = f"{root}.utf8{ext}"
+
+    if not os.path.exists(utf8_path) or os.path.getmtime(utf8_path) < os.path.getmtime(filepath):
+        data = read_utf8(filepath, encoding)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(utf8_path) or '.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, utf8_path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    return utf8_path
+
+def _scan_pops_kernel(values, year_labels):
+    """Loop form of scan_pops, compiled with numba when it is installed."""
+    n, m = values.shape
+    count = 0
+    for r in range(n):
+        for c in range(m):
+            if values[r, c] > 0:
+                count += 1
+
+    rows = np.empty(count, dtype=np.int32)
+    years = np.empty(count, dtype=np.int32)
+    pops = np.empty(count, dtype=np.int64)
+    i = 0
+    for r in range(n):
+        for c in range(m):
+            v = values[r, c]
+            if v > 0:
+                rows[i] = r
+                years[i] = year_labels[c]
+                pops[i] = v
+                i += 1
+    return rows, years, pops
+
+def _scan_pops_numpy(values, year_labels):
+    """Return (row, year, pop) arrays for every positive cell of a rows x years block."""
+    rows, cols = np.nonzero(values > 0)
+    return rows.astype(np.int32), year_labels[cols], values[rows, cols]
+
+@functools.lru_cache(maxsize=None)
+def _numba_kernel():
+    """Return the numba-compiled scan kernel, or None when numba is not installed."""
+    try:
+        from numba import njit
+    except ImportError:  # numba is optional; scan_pops falls back to NumPy
+        return None
+    return njit(cache=True)(_scan_pops_kernel)
 
-    Note: Source CSVs are Windows-1252/Latin-1 encoded, not UTF-8.
+def scan_pops(values, year_labels):
+    """Return (row, year, pop) arrays for every positive cell of a rows x years block.
+
+    Blocks of NUMBA_MIN_CELLS or more use the numba kernel when it is available.
+    """
+    kernel = _numba_kernel() if values.size >= NUMBA_MIN_CELLS else None
+    return (kernel or _scan_pops_numpy)(values, year_labels)
+
+def sort_series(years, pops):
+    """Return year/population arrays sorted by year.
+
+    When a year appears more than once the last population wins, matching
+    the overwrite semantics of filling a dict row by row.
+    """
+    years = np.asarray(years, dtype=np.int32)
+    pops = np.asarray(pops, dtype=np.int64)
+    order = np.argsort(years, kind='stable')
+    years, pops = years[order], pops[order]
+    last = np.ones(len(years), dtype=bool)
+    last[:-1] = years[1:] != years[:-1]
+    return years[last], pops[last]
+
+def merge_series(years, pops, other_years, other_pops):
+    """Merge two sorted year/population series.
+
+    Values from the other series win for years before 1000 and for years
+    missing from the first series.
+    """
+    merged_years = np.union1d(years, other_years)
+    merged_pops = np.empty(len(merged_years), dtype=np.int64)
+    merged_pops[np.searchsorted(merged_years, years)] = pops
+    prefer = (other_years < 1000) | ~np.isin(other_years, years)
+    merged_pops[np.searchsorted(merged_years, other_years[prefer])] = other_pops[prefer]
+    return merged_years, merged_pops
+
+class City:
+    """A city record with its population series as parallel year/pop arrays."""
+
+    __slots__ = ('name', 'other_name', 'country', 'lat', 'lon', 'certainty', 'years', 'pops')
+
+    def __init__(self, name, other_name, country, lat, lon, certainty):
+        self.name = name
+        self.other_name = other_name
+        self.country = country
+        self.lat = lat
+        self.lon = lon
+        self.certainty = certainty
+        self.years = []
+        self.pops = []
+
+@gc_paused()
+def process_wide_csv(filepath, encoding='utf-8'):
+    """Process wide-format CSV where each year is a column into City records.
+
+    Note: Source CSVs are Windows-1252/Latin-1 encoded, not UTF-8; convert
+    them with to_utf8() first, or pass their encoding to transcode in memory.
     """
     cities = {}
 
-    with open(filepath, 'r', encoding=encoding) as f:
-        reader = csv.DictReader(f)
-        headers = reader.fieldnames
-
-        # Find year columns
-        year_cols = [(col, parse_year_column(col)) for col in headers if parse_year_column(col) is not None]
-        year_cols.sort(key=lambda x: x[1])
-
-        for row in reader:
-            city_name = row['City']
-            lat = row.get('Latitude', '')
-            lon = row.get('Longitude', '')
-            country = row.get('Country', '')
-            certainty = row.get('Certainty', '1')
-            other_name = row.get('OtherName', '')
-
-            # Skip if no coordinates
-            if not lat or not lon:
-                continue
-
-            try:
-                lat = float(lat)
-                lon = float(lon)
-            except ValueError:
-                continue
-
-            # Create unique key for city
-            key = f"{city_name}_{lat}_{lon}"
-
-            if key not in cities:
-                cities[key] = {
-                    'name': city_name,
-                    'otherName': other_name,
-                    'country': country,
-                    'lat': lat,
-                    'lon': lon,
-                    'certainty': int(certainty) if certainty else 1,
-                    'populations': {}
-                }
-
-            # Extract population for each year
-            for col_name, year in year_cols:
-                pop = row.get(col_name, '').strip()
-                if pop and pop.isdigit():
-                    pop = int(pop)
-                    if pop > 0:
-                        cities[key]['populations'][year] = pop
+    df = pd.read_csv(io.BytesIO(read_utf8(filepath, encoding)), encoding='utf-8',
+                     dtype=str, keep_default_na=False)
+
+    # Find year columns
+    year_cols, year_labels = year_columns(df.columns)
+
+    for col, default in (('OtherName', ''), ('Country', ''), ('Certainty', '1')):
+        if col not in df:
+            df[col] = default
+
+    # Skip rows without valid coordinates
+    coords = ['Latitude', 'Longitude']
+    df[coords] = df[coords].apply(lambda s: pd.to_numeric(s.str.strip(), errors='coerce'))
+    df = df.dropna(subset=coords)
+
+    row_cities = []
+    for city_name, other_name, country, lat, lon, certainty in zip(
+            df['City'], df['OtherName'], df['Country'],
+            df['Latitude'], df['Longitude'], df['Certainty']):
+        # Create unique key for city; interning shares repeated names
+        city_name = sys.intern(city_name)
+        key = (city_name, lat, lon)
+
+        city = cities.get(key)
+        if city is None:
+            city = cities[key] = City(
+                city_name,
+                sys.intern(other_name),
+                sys.intern(country),
+                lat,
+                lon,
+                int(certainty) if certainty else 1,
+            )
+        row_cities.append(city)
+
+    # Extract population for each year; only the non-empty cells are parsed
+    raw = df[year_cols].to_numpy()
+    filled = raw != ''
+    cells = np.char.strip(raw[filled].astype(str))
+    vals = np.zeros(raw.shape, dtype=np.int64)
+    vals[filled] = np.where(np.char.isdigit(cells), cells, '0').astype(np.int64)
+    rows, years, pops = scan_pops(vals, year_labels)
+    for r, year, pop in zip(rows.tolist(), years.tolist(), pops.tolist()):
+        city = row_cities[r]
+        city.years.append(year)
+        city.pops.append(pop)
+
+    for city in cities.values():
+        city.years, city.pops = sort_series(city.years, city.pops)
 
     return cities
 
 def merge_datasets(chandler, modelski):
-    """Merge two city datasets, preferring Modelski for ancient data."""
-    merged = {}
+    """Merge two city datasets, preferring Modelski for ancient data.
 
-    # Start with Chandler
-    for key, city in chandler.items():
-        merged[key] = city.copy()
-        merged[key]['populations'] = city['populations'].copy()
+    The Chandler dict is updated in place and returned; city records
+    are shared rather than copied.
+    """
+    merged = chandler
 
     # Add/merge Modelski data
     for key, city in modelski.items():
-        if key in merged:
-            # Merge populations, preferring Modelski for overlapping years < 1000
-            for year, pop in city['populations'].items():
-                if year not in merged[key]['populations'] or year < 1000:
-                    merged[key]['populations'][year] = pop
-        else:
-            merged[key] = city.copy()
-            merged[key]['populations'] = city['populations'].copy()
+        dst = merged.get(key)
+        if dst is None:
+            merged[key] = city
+            continue
 
-    return merged
+        # Merge populations, preferring Modelski for overlapping years < 1000
+        dst.years, dst.pops = merge_series(dst.years, dst.pops, city.years, city.pops)
 
-def create_geojson(cities):
-    """Convert cities dict to GeoJSON FeatureCollection."""
-    features = []
+    return merged
 
+def iter_features(cities):
+    """Yield a GeoJSON Feature for each city with population data."""
     for key, city in cities.items():
-        if not city['populations']:
+        # One conversion per array; years are sorted, so the range is free
+        years, pops = city.years.tolist(), city.pops.tolist()
+        if not years:
             continue
 
-        years = sorted(city['populations'].keys())
-        min_year = min(years)
-        max_year = max(years)
-        max_pop = max(city['populations'].values())
+        min_year = years[0]
+        max_year = years[-1]
+        max_pop = max(pops)
 
-        feature = {
+        yield {
             'type': 'Feature',
             'geometry': {
                 'type': 'Point',
-                'coordinates': [city['lon'], city['lat']]
+                'coordinates': [city.lon, city.lat]
             },
             'properties': {
-                'name': city['name'],
-                'otherName': city['otherName'],
-                'country': city['country'],
-                'certainty': city['certainty'],
+                'name': city.name,
+                'otherName': city.other_name,
+                'country': city.country,
+                'certainty': city.certainty,
                 'minYear': min_year,
                 'maxYear': max_year,
                 'maxPopulation': max_pop,
-                'populations': city['populations']
+                'populations': dict(zip(years, pops))
             }
         }
-        features.append(feature)
 
+@gc_paused()
+def create_geojson(cities):
+    """Convert cities dict to GeoJSON FeatureCollection."""
     return {
         'type': 'FeatureCollection',
-        'features': features
+        'features': list(iter_features(cities))
     }
 
 def print_stats(cities):
@@ -141,8 +319,8 @@ def print_stats(cities):
     total_datapoints = 0
 
     for city in cities.values():
-        all_years.update(city['populations'].keys())
-        total_datapoints += len(city['populations'])
+        all_years.update(city.years.tolist())
+        total_datapoints += len(city.years)
 
     if all_years:
         print(f"Total cities: {total_cities}")
@@ -150,21 +328,30 @@ def print_stats(cities):
         print(f"Year range: {min(all_years)} to {max(all_years)}")
 
         # Top 10 cities by max population
-        top_cities = sorted(
-            [(c['name'], max(c['populations'].values())) for c in cities.values() if c['populations']],
-            key=lambda x: -x[1]
-        )[:10]
+        top_cities = heapq.nlargest(
+            10,
+            ((c.name, int(c.pops.max())) for c in cities.values() if len(c.pops)),
+            key=lambda x: x[1]
+        )
         print("\nTop 10 cities by max population:")
         for name, pop in top_cities:
             print(f"  {name}: {pop:,}")
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Preprocess Chandler and Modelski city populations.')
+    output_format = parser.add_mutually_exclusive_group()
+    output_format.add_argument('--ndjson', action='store_true',
+                               help='write one Feature per line (cities.geojsonl) instead of a FeatureCollection')
+    output_format.add_argument('--msgpack', action='store_true',
+                               help='write the FeatureCollection as MessagePack (cities.msgpack)')
+    args = parser.parse_args()
+
     print("Processing Chandler dataset (2250 BC - 1975 AD)...")
-    chandler = process_wide_csv('chandler.csv', encoding='cp1252')
+    chandler = process_wide_csv(to_utf8('chandler.csv', 'cp1252'))
     print(f"  Found {len(chandler)} cities")
 
     print("Processing Modelski dataset (3700 BC - 1000 AD)...")
-    modelski = process_wide_csv('modelski.csv', encoding='latin-1')
+    modelski = process_wide_csv(to_utf8('modelski.csv', 'latin-1'))
     print(f"  Found {len(modelski)} cities")
 
     print("\nMerging datasets...")
@@ -174,11 +361,27 @@ if __name__ == '__main__':
     print_stats(merged)
 
     print("\nCreating GeoJSON...")
-    geojson = create_geojson(merged)
-
-    output_file = 'cities.geojson'
-    with open(output_file, 'w', encoding='utf-8') as f:
-        json.dump(geojson, f, ensure_ascii=False)
+    if args.ndjson:
+        output_file = 'cities.geojsonl'
+        with open(output_file, 'wb') as f:
+            for feature in iter_features(merged):
+                f.write(orjson.dumps(feature, option=ORJSON_OPTIONS | orjson.OPT_APPEND_NEWLINE))
+    elif args.msgpack:
+        import msgpack  # only needed for this optional output
+
+        output_file = 'cities.msgpack'
+        geojson = create_geojson(merged)
+        # msgpack keeps int map keys, which unpackb rejects by default;
+        # use the string year keys the JSON output has
+        for feature in geojson['features']:
+            props = feature['properties']
+            props['populations'] = {str(year): pop for year, pop in props['populations'].items()}
+        with open(output_file, 'wb') as f:
+            msgpack.pack(geojson, f, use_bin_type=True)
+    else:
+        output_file = 'cities.geojson'
+        with open(output_file, 'wb') as f:
+            f.write(orjson.dumps(create_geojson(merged), option=ORJSON_OPTIONS))
 
     print(f"\nSaved to {output_file}")
-    print(f"File size: {len(json.dumps(geojson)) / 1024:.1f} KB")
+    print(f"File size: {os.path.getsize(output_file) / 1024:.1f} KB")
@@ -12,14 +12,11 @@ export async function loadAllData(onProgress, onComplete) {
         }
     }
 
-    // Load polities (split across multiple files for GitHub size limits)
-    const polityFiles = [
-        'data/cliopatria_polities_part1.geojson',
-        'data/cliopatria_polities_part2.geojson',
-        'data/cliopatria_polities_part3.geojson'
-    ];
-
-    Promise.all(polityFiles.map(file => fetch(file).then(r => r.json())))
+    // Load polities (split across multiple files for GitHub size limits;
+    // scripts/split_geojson.py writes the list of parts to a manifest)
+    fetch('data/cliopatria_polities_parts.json')
+        .then(r => r.json())
+        .then(polityFiles => Promise.all(polityFiles.map(file => fetch(`data/${file}`).then(r => r.json()))))
         .then(parts => {
             // Merge all features from all parts
             state.allPolities = parts.flatMap(part => part.features);
@@ -1,69 +1,157 @@
 #!/usr/bin/env python3
 """Split a large GeoJSON FeatureCollection into parts under a size limit."""
 
-import json
+import argparse
+import glob
 import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import orjson
 
 INPUT_FILE = 'data/cliopatria_polities_only.geojson'
 OUTPUT_DIR = 'data'
+OUTPUT_PREFIX = 'cliopatria_polities'
 MAX_SIZE_MB = 90  # Target max size per file
 
-def main():
-    print(f"Loading {INPUT_FILE}...")
-    with open(INPUT_FILE, 'r') as f:
-        data = json.load(f)
+PART_HEADER = b'{"type":"FeatureCollection","features":['
+PART_FOOTER = b']}'
+WRITE_BUFFER_SIZE = 1 << 20
+READ_CHUNK_SIZE = 1 << 20
+RECORD_SEPARATOR = b'\x1e'
+
+def split_records(f, sep, chunk_size=READ_CHUNK_SIZE):
+    """Yield the sep-delimited records of a binary file, reading it in chunks."""
+    tail = b''
+    while chunk := f.read(chunk_size):
+        *records, tail = (tail + chunk).split(sep)
+        yield from records
+    yield tail
+
+def iter_encoded_features(path, ndjson=False):
+    """Yield each feature of a GeoJSON file as JSON bytes.
+
+    Sequence input is streamed one record at a time. Records are split on
+    newlines, or on RFC 8142 record separators when the file starts with
+    one, so a text sequence may spread each Feature over several lines.
+    Every record is checked to be a JSON object before it is passed on.
+    """
+    with open(path, 'rb') as f:
+        if ndjson:
+            rfc8142 = f.read(1) == RECORD_SEPARATOR
+            f.seek(0)
+            records = split_records(f, RECORD_SEPARATOR) if rfc8142 else f
+            kind = 'record' if rfc8142 else 'line'
+            for n, record in enumerate(records, 1):
+                record = record.lstrip(RECORD_SEPARATOR).strip()
+                if not record:
+                    continue
+                try:
+                    feature = orjson.loads(record)
+                except orjson.JSONDecodeError as e:
+                    raise ValueError(f"{path}: {kind} {n}: {e}") from None
+                if not isinstance(feature, dict):
+                    raise ValueError(f"{path}: {kind} {n}: expected a JSON object")
+                yield record
+            return
+        data = orjson.loads(f.read())
+
+    for feat in data['features']:
+        yield orjson.dumps(feat)
+
+def write_part(output_file, encoded_features):
+    """Write pre-encoded features as a FeatureCollection and return its size in bytes."""
+    with open(output_file, 'wb', buffering=WRITE_BUFFER_SIZE) as f:
+        size = f.write(PART_HEADER)
+        for i, enc in enumerate(encoded_features):
+            if i:
+                size += f.write(b',')
+            size += f.write(enc)
+        size += f.write(PART_FOOTER)
+
+    return size
+
+def remove_stale_parts(output_dir, prefix, count):
+    """Delete parts numbered above count left over from an earlier, larger split."""
+    pattern = re.compile(re.escape(prefix) + r'_part(\d+)\.geojson')
+    for path in glob.glob(os.path.join(output_dir, f'{glob.escape(prefix)}_part*.geojson')):
+        match = pattern.fullmatch(os.path.basename(path))
+        if match and int(match.group(1)) > count:
+            print(f"Removing stale {path}")
+            os.remove(path)
+
+def write_manifest(output_dir, prefix, part_files):
+    """Write the list of part file names the map loader fetches."""
+    manifest_file = os.path.join(output_dir, f'{prefix}_parts.json')
+    names = [os.path.basename(path) for path in part_files]
+    with open(manifest_file, 'wb') as f:
+        f.write(orjson.dumps(names, option=orjson.OPT_INDENT_2 | orjson.OPT_APPEND_NEWLINE))
+    return manifest_file
 
-    features = data['features']
-    total = len(features)
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('input', nargs='?', default=INPUT_FILE, help='GeoJSON file to split')
+    parser.add_argument('--ndjson', action='store_true',
+                        help='input is newline-delimited GeoJSON (one Feature per line) or an '
+                             'RFC 8142 GeoJSON text sequence, instead of a FeatureCollection')
+    parser.add_argument('--output-dir', default=OUTPUT_DIR, help='directory to write the parts to')
+    parser.add_argument('--output-prefix',
+                        help=f'part file name prefix (default: {OUTPUT_PREFIX} for the default input, '
+                             'otherwise the input file name without its extension)')
+    args = parser.parse_args()
+
+    prefix = args.output_prefix
+    if prefix is None:
+        if args.input == INPUT_FILE:
+            prefix = OUTPUT_PREFIX
+        else:
+            prefix = os.path.splitext(os.path.basename(args.input))[0]
 
-    print(f"Total features: {total}")
+    print(f"Loading {args.input}...")
     print(f"Target max size per file: {MAX_SIZE_MB} MB")
 
-    # Calculate size of each feature
-    print("Calculating feature sizes...")
-    feature_sizes = []
-    for feat in features:
-        size = len(json.dumps(feat))
-        feature_sizes.append(size)
+    # Encode each feature once and split on cumulative encoded size
+    print("Encoding features...")
+    encoded = list(iter_encoded_features(args.input, args.ndjson))
+    total = len(encoded)
 
-    # Split into parts based on cumulative size
     max_bytes = MAX_SIZE_MB * 1024 * 1024
-    overhead = 50  # JSON structure overhead per file
+    budget = max_bytes - len(PART_HEADER) - len(PART_FOOTER)
 
-    parts = []
-    current_part = []
-    current_size = overhead
-
-    for i, feat in enumerate(features):
-        feat_size = feature_sizes[i]
-        if current_size + feat_size > max_bytes and current_part:
-            parts.append(current_part)
-            current_part = [feat]
-            current_size = overhead + feat_size
-        else:
-            current_part.append(feat)
-            current_size += feat_size
+    # Each feature costs its encoded length plus a separating comma
+    sizes = np.fromiter((len(enc) + 1 for enc in encoded), dtype=np.int64, count=total)
+    cumulative = np.cumsum(sizes)
 
-    if current_part:
-        parts.append(current_part)
+    parts = []
+    start = 0
+    while start < total:
+        used = cumulative[start - 1] if start else 0
+        end = int(np.searchsorted(cumulative, used + budget, side='right'))
+        end = max(end, start + 1)  # an oversized feature still gets its own part
+        parts.append(encoded[start:end])
+        start = end
 
+    print(f"Total features: {total}")
     print(f"Split into {len(parts)} parts")
 
-    # Write each part
-    for i, part_features in enumerate(parts):
-        part_data = {
-            "type": "FeatureCollection",
-            "features": part_features
-        }
-
-        output_file = os.path.join(OUTPUT_DIR, f'cliopatria_polities_part{i + 1}.geojson')
-        print(f"Writing {output_file} ({len(part_features)} features)...")
-
-        with open(output_file, 'w') as f:
-            json.dump(part_data, f)
-
-        size_mb = os.path.getsize(output_file) / (1024 * 1024)
-        print(f"  Size: {size_mb:.2f} MB")
+    # Write the parts concurrently; file writes release the GIL
+    with ThreadPoolExecutor() as pool:
+        futures = []
+        for i, part_features in enumerate(parts):
+            output_file = os.path.join(args.output_dir, f'{prefix}_part{i + 1}.geojson')
+            print(f"Writing {output_file} ({len(part_features)} features)...")
+            futures.append((output_file, pool.submit(write_part, output_file, part_features)))
+
+        for output_file, future in futures:
+            size_mb = future.result() / (1024 * 1024)
+            print(f"  {output_file}: {size_mb:.2f} MB")
+
+    # The part count depends on the encoding, so drop leftovers from earlier
+    # runs and record which parts the loader should fetch
+    remove_stale_parts(args.output_dir, prefix, len(parts))
+    manifest_file = write_manifest(args.output_dir, prefix, [output_file for output_file, _ in futures])
+    print(f"Wrote {manifest_file}")
 
     print(f"\nCreated {len(parts)} files. You can now delete the original.")
 